@@ -1,2 +1,2 @@
 from .assemble_model import AssembleModel
-from .learning_table import LearningTable
+from .learning_table import LearningTable, create_data_loader
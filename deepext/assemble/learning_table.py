@@ -1,9 +1,32 @@
-from torch.utils.data import DataLoader
+import os
+
+import torch
+from torch.utils.data import DataLoader, Dataset
 from typing import List, Callable
 
 
+def create_data_loader(dataset: Dataset, batch_size: int, shuffle=True, num_workers: int = None,
+                       pin_memory=True, persistent_workers=True, prefetch_factor=2) -> DataLoader:
+    """
+    GPUを待たせないworker設定のDataLoaderを生成する.
+    :param num_workers: Noneの場合はCPUコア数から自動設定(最大8).
+    :param prefetch_factor: 2より大きくしてもOOMリスクが増えるだけで効果は薄い.
+    """
+    if num_workers is None:
+        num_workers = min(max((os.cpu_count() or 2) - 2, 0), 8)
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs["persistent_workers"] = persistent_workers
+        worker_kwargs["prefetch_factor"] = prefetch_factor
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=pin_memory and torch.cuda.is_available(), **worker_kwargs)
+
+
 class LearningTable:
     def __init__(self, epochs: int, data_loader: DataLoader, callbacks: List[Callable[[int, ], None]] or None):
+        if torch.cuda.is_available() and not data_loader.pin_memory:
+            print("Warning: data_loader is built without pin_memory=True, so H2D transfer cannot overlap compute. "
+                  "Consider building it with create_data_loader.")
         self.epochs = epochs
         self.data_loader = data_loader  # バギングを考慮
         self.callbacks = callbacks
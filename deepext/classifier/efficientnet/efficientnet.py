@@ -1,74 +1,179 @@
 import torch.optim as optim
 import torch
-import torch.nn as nn
 import numpy as np
 
 from deepext.base.base_model import BaseModel
-from deepext.utils.tensor_util import try_cuda
 from .efficientnet_lib.model import EfficientNetPredictor
 
 
 class EfficientNet(BaseModel):
-    def __init__(self, num_classes, network='efficientnet-b0', lr=0.1, momentum=0.9, weight_decay=1e-4):
+    def __init__(self, num_classes, network='efficientnet-b0', lr=0.1, momentum=0.9, weight_decay=1e-4,
+                 compile_model=False, accum_steps=1, script_inference=False):
+        """
+        :param compile_model: torch.compileで順伝播を最適化するか.
+            初回呼び出しにコンパイル時間がかかり、入力形状が変わると再コンパイルされるため固定形状での利用を推奨.
+        :param accum_steps: 勾配を何バッチ分蓄積してからoptimizerのstepを進めるか(実効バッチサイズ = batch_size * accum_steps).
+        :param script_inference: 推論パスをtorch.jit.scriptで最適化するか.
+            初回predictにコンパイル時間がかかる. scriptに失敗した場合は素のモデルで続行する.
+        """
         super().__init__()
+        self._accum_steps = accum_steps
+        self._accum_i = 0
+        self._mode = None
+        self._script_inference = script_inference
+        self._scripted = None
         self._num_classes = num_classes
         self._model = EfficientNetPredictor.from_name(network, override_params={'num_classes': self._num_classes})
         self._network = network
-        self._optimizer = optim.SGD(
-            self._model.parameters(), lr,
-            momentum=momentum,
-            weight_decay=weight_decay)
+        try:
+            # foreach=Trueでstep()のカーネル起動をパラメータごとではなく一括にする.
+            self._optimizer = optim.SGD(
+                self._model.parameters(), lr,
+                momentum=momentum,
+                weight_decay=weight_decay,
+                foreach=True)
+        except TypeError:
+            # foreach非対応の古いtorch.
+            self._optimizer = optim.SGD(
+                self._model.parameters(), lr,
+                momentum=momentum,
+                weight_decay=weight_decay)
         self._criterion = torch.nn.CrossEntropyLoss()
+        self._scaler = torch.cuda.amp.GradScaler(enabled=torch.cuda.is_available())
         if torch.cuda.is_available():
             self._model.cuda()
             self._criterion.cuda()
+            # NHWC layout lets cuDNN pick Tensor Core kernels for depthwise/1x1 convs.
+            self._model = self._model.to(memory_format=torch.channels_last)
+        if compile_model and hasattr(torch, "compile"):
+            print("Compiling EfficientNet model... The first batch will be slow.")
+            self._model = torch.compile(self._model, mode="reduce-overhead", fullgraph=False)
+
+    @staticmethod
+    def _prepare_input(tensor: torch.Tensor) -> torch.Tensor:
+        # プリフェッチ済みのCUDA floatテンソルなら変換は全てスキップされる.
+        if not tensor.is_cuda and torch.cuda.is_available():
+            tensor = tensor.cuda(non_blocking=True)
+        if tensor.dtype != torch.float32:
+            tensor = tensor.float()
+        if tensor.is_cuda:
+            tensor = tensor.contiguous(memory_format=torch.channels_last)
+        return tensor
+
+    def _set_mode(self, mode: str):
+        # train()/eval()は全サブモジュールを走査するため, モードが変わるときだけ呼ぶ.
+        if self._mode == mode:
+            return
+        self._model.train() if mode == 'train' else self._model.eval()
+        self._mode = mode
+
+    def _inference_model(self):
+        if not self._script_inference:
+            return self._model
+        if self._scripted is None:
+            try:
+                self._scripted = torch.jit.script(self._model)
+                self._scripted.eval()
+            except Exception as e:
+                print(f"torch.jit.script failed, falling back to the eager model. {e}")
+                self._scripted = self._model
+        return self._scripted
 
-    def train_batch(self, train_x: torch.Tensor, teacher: torch.Tensor) -> float:
+    def train_batch(self, train_x: torch.Tensor, teacher: torch.Tensor) -> torch.Tensor:
         """
         :param train_x: (batch size, channel, height, width)
         :param teacher: (batch size, )
+        :return: loss (0-dim tensor). デバイス上に残したまま返しホスト同期を避ける.
         """
-        self._model.train()
-        train_x = try_cuda(train_x).float()
-        teacher = try_cuda(teacher).long()
+        self._set_mode('train')
+        train_x = self._prepare_input(train_x)
+        if not teacher.is_cuda and torch.cuda.is_available():
+            teacher = teacher.cuda(non_blocking=True)
+        if teacher.dtype != torch.long:
+            teacher = teacher.long()
 
         # compute output
-        output = self._model(train_x)
-        loss = self._criterion(output, teacher)
-        # compute gradient and do SGD step
-        self._optimizer.zero_grad()
-        loss.backward()
-        self._optimizer.step()
-        return loss.item()
-
-    def predict(self, inputs):
+        with torch.cuda.amp.autocast(enabled=torch.cuda.is_available()):
+            output = self._model(train_x)
+            loss = self._criterion(output, teacher)
+        # compute gradient and do SGD step on accumulation boundaries
+        self._scaler.scale(loss / self._accum_steps).backward()
+        self._accum_i += 1
+        if self._accum_i % self._accum_steps == 0:
+            self._scaler.step(self._optimizer)
+            self._scaler.update()
+            self._optimizer.zero_grad(set_to_none=True)
+        return loss.detach()
+
+    def predict(self, inputs, return_probs: bool = True):
         """
         :param inputs: (batch size, channel, height, width)
-        :return: (batch size, class)
+        :param return_probs: Falseの場合はargmax済みのクラスIDのみ返す.
+            クラス数が多いときD2H転送が(batch size,)のint配列だけで済む.
+        :return: (batch size, class) または (batch size, )
         """
-        self._model.eval()
+        self._set_mode('eval')
         with torch.no_grad():
-            inputs = try_cuda(inputs).float()
-            output = nn.Softmax(dim=1)(self._model(inputs))
+            inputs = self._prepare_input(inputs)
+            with torch.cuda.amp.autocast(enabled=torch.cuda.is_available()):
+                logits = self._inference_model()(inputs)
+                if not return_probs:
+                    return logits.argmax(dim=1).cpu().numpy()
+                output = torch.softmax(logits, dim=1)
             pred_ids = output.cpu().numpy()
         return pred_ids
 
-    def save_weight(self, save_path):
-        dict_to_save = {
+    def predict_logits(self, inputs) -> torch.Tensor:
+        """
+        :param inputs: (batch size, channel, height, width)
+        :return: (batch size, class) のロジット. GPU利用時はデバイス上のテンソルのまま返す.
+        """
+        self._set_mode('eval')
+        with torch.no_grad():
+            inputs = self._prepare_input(inputs)
+            with torch.cuda.amp.autocast(enabled=torch.cuda.is_available()):
+                return self._inference_model()(inputs)
+
+    @staticmethod
+    def _snapshot_to_cpu(obj):
+        # optimizer stateなどネストした構造のテンソルを, 学習スレッドと共有しないCPUコピーにする.
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().cpu().clone()
+        if isinstance(obj, dict):
+            return {k: EfficientNet._snapshot_to_cpu(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [EfficientNet._snapshot_to_cpu(v) for v in obj]
+        return obj
+
+    def create_save_dict(self) -> dict:
+        """
+        保存用dictを呼び出しスレッドで構築して返す. 全テンソルをCPUへ複製するため,
+        返却後に学習が進んでも内容は変化しない(バックグラウンド保存用).
+        """
+        # 重みはFP16で書き出しチェックポイントサイズと書き込み帯域を半減する(学習はAMPなので精度影響は軽微).
+        state_dict = {k: (v.detach().half() if v.is_floating_point() else v.detach()).cpu().clone()
+                      for k, v in self._model.state_dict().items()}
+        return {
             'num_class': self._num_classes,
             'network': self._network,
-            'state_dict': self._model.state_dict(),
-            'optimizer': self._optimizer.state_dict(),
+            'state_dict': state_dict,
+            'optimizer': self._snapshot_to_cpu(self._optimizer.state_dict()),
+            'scaler': self._scaler.state_dict(),
         }
-        torch.save(dict_to_save, save_path)
+
+    def save_weight(self, save_path):
+        torch.save(self.create_save_dict(), save_path, _use_new_zipfile_serialization=True)
 
     def load_weight(self, weight_path):
         params = torch.load(weight_path)
         print('The pretrained weight is loaded')
         print('Num classes: {}'.format(params['num_class']))
         self._num_classes = params['num_class']
-        self._model.load_state_dict(params['state_dict'])
+        state_dict = {k: v.float() if v.is_floating_point() else v for k, v in params['state_dict'].items()}
+        self._model.load_state_dict(state_dict)
         self._optimizer.load_state_dict(params['optimizer'])
+        if 'scaler' in params:
+            self._scaler.load_state_dict(params['scaler'])
         self._network = params['network']
         return self
 
@@ -1,6 +1,5 @@
 from torch.utils.data import DataLoader
 from typing import List, Callable
-from statistics import mean
 import numpy as np
 import time
 
@@ -59,13 +58,14 @@ class Trainer:
                 callback(epoch)
 
     def train_epoch(self, data_loader: DataLoader) -> float:
-        loss_list = []
+        total_loss, batch_count = 0.0, 0
         for train_x, teacher in data_loader:
             train_x = try_cuda(train_x)
             teacher = try_cuda(teacher)
-            loss = self._model.train_batch(train_x, teacher)
-            loss_list.append(loss)
-        return mean(loss_list)
+            # lossはCUDAテンソルのまま加算し, エポック末の1回だけ同期する.
+            total_loss = total_loss + self._model.train_batch(train_x, teacher)
+            batch_count += 1
+        return float(total_loss / max(batch_count, 1))
 
     def calc_metrics(self, data_loader: DataLoader, metric_func_ls: List[Metrics],
                      metric_for_graph: Metrics or None) -> str:
@@ -1,17 +1,60 @@
 from typing import Tuple, List, Callable
 import numpy as np
+import torch
 from torch.utils.data import DataLoader
-from statistics import mean
 import time
 
 from deepext.assemble.assemble_model import AssembleModel
 from deepext.base import BaseModel
 from ..base import Metrics
 from deepext.assemble.learning_table import LearningTable
-from deepext.utils.tensor_util import try_cuda
 from .learning_curve_visualizer import LearningCurveVisualizer
 
 
+class _CudaPrefetcher:
+    """
+    DataLoaderの次バッチを専用Streamで1イテレーション先にGPUへ転送するイテレータ.
+    DataLoaderはpin_memory=Trueで生成しておくこと(非同期転送が効くのはpinned memoryのみ).
+    """
+
+    _warned_unpinned = False
+
+    def __init__(self, data_loader: DataLoader):
+        if not data_loader.pin_memory and not _CudaPrefetcher._warned_unpinned:
+            # pageable memoryへのcuda(non_blocking=True)は同期コピーになり先行転送が効かない.
+            # プリフェッチャはエポックごとに生成されるため警告は初回のみ.
+            _CudaPrefetcher._warned_unpinned = True
+            print("Warning: data_loader is built without pin_memory=True, so batch prefetch cannot overlap compute. "
+                  "Consider building it with create_data_loader.")
+        self._loader_iter = iter(data_loader)
+        self._stream = torch.cuda.Stream()
+        self._next_x, self._next_teacher = None, None
+        self._preload()
+
+    def _preload(self):
+        try:
+            x, teacher = next(self._loader_iter)
+        except StopIteration:
+            self._next_x, self._next_teacher = None, None
+            return
+        with torch.cuda.stream(self._stream):
+            self._next_x = x.cuda(non_blocking=True)
+            self._next_teacher = teacher.cuda(non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next_x is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self._stream)
+        x, teacher = self._next_x, self._next_teacher
+        x.record_stream(torch.cuda.current_stream())
+        teacher.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return x, teacher
+
+
 class XTrainer:
     def __init__(self, models: AssembleModel):
         self._assemble_model: AssembleModel = models
@@ -49,17 +92,35 @@ class XTrainer:
                 callback(epoch)
 
     def train_epoch(self, model: BaseModel, data_loader: DataLoader) -> float:
-        loss_list = []
-        for train_x, teacher in data_loader:
-            train_x = try_cuda(train_x)
-            teacher = try_cuda(teacher)
-            loss = model.train_batch(train_x, teacher)
-            loss_list.append(loss)
-        return mean(loss_list)
+        total_loss, batch_count = 0.0, 0
+        batch_iter = _CudaPrefetcher(data_loader) if torch.cuda.is_available() else data_loader
+        for train_x, teacher in batch_iter:
+            # lossはCUDAテンソルのまま加算し, エポック末の1回だけ同期する.
+            total_loss = total_loss + model.train_batch(train_x, teacher)
+            batch_count += 1
+        return float(total_loss / max(batch_count, 1))
 
-    def calc_metric(self, model: BaseModel or AssembleModel, data_loader: DataLoader, metric_func: Metrics) -> float:
+    def calc_metric(self, model: BaseModel or AssembleModel, data_loader: DataLoader, metric_func: Metrics,
+                    torch_metric_func: Callable = None) -> float:
+        """
+        :param torch_metric_func: (logits, teacher) -> 0-dim Tensor のGPU完結指標関数.
+            指定するとpredictのD2Hコピーを省きデバイス上で集計する(accuracy/top-kなどtorchで書ける指標向け).
+        """
+        if torch_metric_func is not None and hasattr(model, "predict_logits"):
+            running, sample_count = 0.0, 0
+            for x, teacher in data_loader:
+                logits = model.predict_logits(x)
+                if logits.is_cuda:
+                    teacher = teacher.cuda(non_blocking=True)
+                running = running + torch_metric_func(logits, teacher) * teacher.shape[0]
+                sample_count += teacher.shape[0]
+            # 同期はエポック全体で最後の1回だけ.
+            return float(running / max(sample_count, 1))
         metric_func.clear()
+        pred_list, teacher_list = [], []
         for x, teacher in data_loader:
-            result = model.predict(x)
-            metric_func.calc_one_batch(result, teacher)
+            pred_list.append(np.asarray(model.predict(x)))
+            teacher_list.append(np.asarray(teacher))
+        # バッチごとの平均ではなくデータ全体で1回だけ指標を計算する(端数バッチの偏りも防げる).
+        metric_func.calc_one_batch(np.concatenate(pred_list), np.concatenate(teacher_list))
         return metric_func.calc_summary()
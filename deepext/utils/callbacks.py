@@ -1,8 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from torchvision.transforms import ToPILImage
 from torch.utils.data import Dataset
 import torch
-import math
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import seaborn as sns
 from pathlib import Path
 
@@ -11,28 +12,59 @@ from ..base import SegmentationModel, BaseModel, DetectionModel
 from ..classifier import AttentionBranchNetwork
 
 
+def _print_if_failed(future):
+    """バックグラウンドタスクの例外を握りつぶさず表示する."""
+    error = future.exception()
+    if error is not None:
+        print(f"Background task failed: {repr(error)}")
+
+
+class _CachedDataset(Dataset):
+    """
+    可視化用の小さいデータセット向けに__getitem__の結果をメモ化するラッパー.
+    2回目以降のアクセスで画像デコード・transformを省く.
+    """
+
+    def __init__(self, dataset: Dataset):
+        self._dataset = dataset
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx not in self._cache:
+            self._cache[idx] = self._dataset[idx]
+        return self._cache[idx]
+
+
 class GenerateSegmentationImageCallback:
     def __init__(self, model: SegmentationModel, output_dir: str, per_epoch: int, dataset: Dataset, alpha=150,
                  color_palette_ls: List[int] = None):
         self._model: SegmentationModel = model
         self._output_dir = output_dir
         self._per_epoch = per_epoch
-        self._dataset = dataset
+        self._dataset = _CachedDataset(dataset)
         self._alpha = alpha
         self._to_pil = ToPILImage()
         self._color_palette = color_palette_ls or default_color_palette()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._data_len = len(dataset)
+        self._rng = np.random.default_rng()
+        self._path_template = f"{output_dir}/result_image{{}}.png"
 
     def __call__(self, epoch: int):
         if (epoch + 1) % self._per_epoch != 0:
             return
-        data_len = len(self._dataset)
-        random_image_index = np.random.randint(0, data_len)
+        random_image_index = self._rng.integers(0, self._data_len)
         img_tensor, _ = self._dataset[random_image_index]
-
+        # 推論は学習スレッドで行う(別スレッドだとtrain()/eval()フラグやBN統計が学習と競合する).
+        # バックグラウンドへ回すのはディスク書き込みだけ.
         result_img = self._model.draw_predicted_result(img_tensor, img_size_for_model=img_tensor.shape[1:],
                                                        color_palette=self._color_palette)
-        result_img.save(
-            f"{self._output_dir}/result_image{epoch + 1}.png")
+        self._pool.submit(result_img.save, self._path_template.format(epoch + 1)) \
+            .add_done_callback(_print_if_failed)
 
 
 class LearningRateScheduler:
@@ -41,7 +73,7 @@ class LearningRateScheduler:
         self._power = power
 
     def __call__(self, epoch: int):
-        return math.pow((1 - epoch / self._max_epoch), self._power)
+        return (1 - epoch / self._max_epoch) ** self._power
 
 
 class WarmUpLRScheduler:
@@ -61,28 +93,39 @@ class WarmUpLRScheduler:
 
 class GenerateAttentionMapCallback:
     def __init__(self, output_dir: str, per_epoch: int, dataset: Dataset, model: AttentionBranchNetwork):
-        self._out_dir, self._per_epoch, self._dataset = output_dir, per_epoch, dataset
+        self._out_dir, self._per_epoch, self._dataset = output_dir, per_epoch, _CachedDataset(dataset)
         self._model = model
         self._to_pil = ToPILImage()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        # pyplotのグローバルfigure管理に載せないFigureを使う(スレッドセーフでなくclose漏れ警告も出るため).
+        self._fig = Figure()
+        FigureCanvasAgg(self._fig)
+        self._data_len = len(dataset)
+        self._rng = np.random.default_rng()
 
     def __call__(self, epoch: int):
         if (epoch + 1) % self._per_epoch != 0:
             return
+        # 推論とD2Hコピーは学習スレッドで済ませ, 描画・保存だけバックグラウンドへ回す.
         self._model.eval()
-        data_len = len(self._dataset)
-        random_image_index = np.random.randint(0, data_len)
+        random_image_index = self._rng.integers(0, self._data_len)
         img_tensor, label = self._dataset[random_image_index]
-        img_tensor = img_tensor.view(1, img_tensor.shape[0], img_tensor.shape[1], img_tensor.shape[2]).cuda()
+        img_tensor = img_tensor.unsqueeze(0).contiguous().pin_memory().to('cuda', non_blocking=True)
         perception_pred, attention_pred, attention_map = self._model(img_tensor)
         pred_label = perception_pred.argmax(-1).item()
 
         img: Image.Image = self._to_pil(img_tensor.detach().cpu()[0])
-        img.save(f"{self._out_dir}/epoch{epoch + 1}_t{label}_p{pred_label}.png")
+        # detachしてからCPUへコピーする(勾配情報を転送しない).
+        attention_map = attention_map.detach().cpu().numpy()[0][0]
+        self._pool.submit(self._save_images, epoch, img, label, pred_label, attention_map) \
+            .add_done_callback(_print_if_failed)
 
-        plt.figure()
-        sns.heatmap(attention_map.cpu().detach().numpy()[0][0])
-        plt.savefig(f"{self._out_dir}/epoch{epoch + 1}_attention.png")
-        plt.close('all')
+    def _save_images(self, epoch: int, img: Image.Image, label, pred_label, attention_map: np.ndarray):
+        img.save(f"{self._out_dir}/epoch{epoch + 1}_t{label}_p{pred_label}.png")
+        self._fig.clear()
+        ax = self._fig.add_subplot(111)
+        sns.heatmap(attention_map, ax=ax)
+        self._fig.savefig(f"{self._out_dir}/epoch{epoch + 1}_attention.png")
 
 
 class VisualizeRandomObjectDetectionResult:
@@ -98,25 +141,29 @@ class VisualizeRandomObjectDetectionResult:
         :param teacher_color:
         """
         self._model = model
-        self._dataset = dataset
+        self._dataset = _CachedDataset(dataset)
         self._pred_color = pred_color
         self._teacher_color = teacher_color
         self._per_epoch = per_epoch
         self._out_dir = out_dir
         self._img_size = img_size
         self._label_names = label_names
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._data_len = len(dataset)
+        self._rng = np.random.default_rng()
 
     def __call__(self, epoch: int):
         if (epoch + 1) % self._per_epoch != 0:
             return
-        data_len = len(self._dataset)
-        random_image_index = np.random.randint(0, data_len)
+        random_image_index = self._rng.integers(0, self._data_len)
         image, teacher_bboxes = self._dataset[random_image_index]
         assert isinstance(image, torch.Tensor), "Expected image type is Tensor."
+        # 推論・描画は学習スレッドで行い, ディスク書き込みだけバックグラウンドへ回す.
         result_img = self._model.draw_predicted_result(image, img_size_for_model=(image.shape[-2], image.shape[-1]),
                                                        label_names=self._label_names)
         image = self._draw_teacher_bboxes(result_img, teacher_bboxes=teacher_bboxes)
-        cv2.imwrite(f"{self._out_dir}/result_{epoch + 1}.png", image)
+        self._pool.submit(cv2.imwrite, f"{self._out_dir}/result_{epoch + 1}.png", image) \
+            .add_done_callback(_print_if_failed)
 
     def _draw_teacher_bboxes(self, image: np.ndarray, teacher_bboxes: List[Tuple[float, float, float, float, int]]):
         """
@@ -137,10 +184,19 @@ class ModelCheckout:
         self._per_epoch = per_epoch
         self._out_dir = Path(our_dir)
         self._model = model
+        self._pool = ThreadPoolExecutor(max_workers=1)
         if not self._out_dir.exists():
             self._out_dir.mkdir()
 
     def __call__(self, epoch: int):
         if (epoch + 1) % self._per_epoch != 0:
             return
-        self._model.save_weight(str(self._out_dir.joinpath(f"{self._model.__class__.__name__}_ep{epoch + 1}.pth")))
+        save_path = str(self._out_dir.joinpath(f"{self._model.__class__.__name__}_ep{epoch + 1}.pth"))
+        create_save_dict = getattr(self._model, "create_save_dict", None)
+        if create_save_dict is None:
+            # CPUスナップショット手段がないモデルは, 学習中のテンソルと競合しないよう同期保存する.
+            self._model.save_weight(save_path)
+            return
+        # テンソルは呼び出しスレッドでCPUへ複製済みなので, バックグラウンドへ回すのはディスク書き込みだけ.
+        # max_workers=1なので保存順は保たれる.
+        self._pool.submit(torch.save, create_save_dict(), save_path).add_done_callback(_print_if_failed)
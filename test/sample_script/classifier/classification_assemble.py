@@ -5,7 +5,7 @@ import torchvision
 from torchvision.transforms import ToTensor, Resize, RandomHorizontalFlip, RandomRotation, Compose, RandomResizedCrop
 import json
 from deepext import AttentionBranchNetwork, Trainer, ResNetAttentionBranchNetwork, \
-    AssembleModel, LearningTable, XTrainer, MobileNetV3
+    AssembleModel, LearningTable, XTrainer, MobileNetV3, create_data_loader
 from deepext.layers import classification_accuracy
 
 from deepext.utils import *
@@ -22,8 +22,8 @@ def stl10_setting(preset_transforms: List) -> Tuple[DataLoader, Dataset, int, Da
 
     test_dataset = torchvision.datasets.STL10(root=settings["stl10_root"], download=True, split="test",
                                               transform=Compose([Resize(size), ToTensor()]))
-    return DataLoader(dataset, batch_size=8, shuffle=True), dataset, 10, DataLoader(test_dataset, batch_size=8,
-                                                                                    shuffle=True)
+    return create_data_loader(dataset, batch_size=8, shuffle=True), dataset, 10, \
+           create_data_loader(test_dataset, batch_size=8, shuffle=True)
 
 
 def cifar10_setting(preset_transforms: List) -> Tuple[DataLoader, Dataset, int, DataLoader]:
@@ -33,8 +33,8 @@ def cifar10_setting(preset_transforms: List) -> Tuple[DataLoader, Dataset, int,
                                            transform=img_transforms)
     test_dataset = torchvision.datasets.CIFAR10(root=settings["cifar10_root"], download=True, train=False,
                                                 transform=Compose([Resize(size), ToTensor()]))
-    return DataLoader(dataset, batch_size=64, shuffle=True), dataset, 10, DataLoader(test_dataset, batch_size=8,
-                                                                                     shuffle=True)
+    return create_data_loader(dataset, batch_size=64, shuffle=True), dataset, 10, \
+           create_data_loader(test_dataset, batch_size=8, shuffle=True)
 
 
 dataset_type = "cifar10"
@@ -5,7 +5,7 @@ import torchvision
 from torch.utils.data import DataLoader, Dataset
 
 from deepext import AttentionBranchNetwork, Trainer, EfficientNet, MobileNetV3, BaseModel, LearningRateScheduler, \
-    AssembleModel, XTrainer, LearningTable
+    AssembleModel, XTrainer, LearningTable, create_data_loader
 from deepext.utils.tensor_util import try_cuda
 from deepext.layers import ClassificationAccuracy
 from deepext.utils import *
@@ -42,8 +42,8 @@ def get_dataloader(setting: DataSetSetting, root_dir: str, batch_size: int) -> T
         test_dataset = torchvision.datasets.CIFAR10(root=root_dir, download=True, train=False,
                                                     transform=test_transforms)
     assert train_dataset is not None and test_dataset is not None, f"Not supported setting: {setting.dataset_type}"
-    return DataLoader(train_dataset, batch_size=batch_size, shuffle=True), \
-           DataLoader(test_dataset, batch_size=batch_size, shuffle=True), train_dataset, test_dataset
+    return create_data_loader(train_dataset, batch_size=batch_size, shuffle=True), \
+           create_data_loader(test_dataset, batch_size=batch_size, shuffle=True), train_dataset, test_dataset
 
 
 def get_model(dataset_setting: DataSetSetting, model_type: str, lr: float, efficientnet_scale: int = 0):